@@ -2,10 +2,25 @@
 """Prepare dataset for FLUX.1-dev LoRA training by merging base images with new Ankys."""
 
 import argparse
+import os
 import shutil
 from pathlib import Path
 
 
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a copy across filesystems."""
+    # Already linked (or output_dir is a source dir): nothing to do, and
+    # unlinking here would delete the source itself
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    # Replace rather than write through an existing link into the source file
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--base_dir", type=str, required=True, help="Base dataset directory")
@@ -28,8 +43,8 @@ def main():
             if img.suffix.lower() in [".png", ".jpg", ".jpeg", ".webp"]:
                 cap = img.with_suffix(".txt")
                 if cap.exists():
-                    shutil.copy2(img, output / img.name)
-                    shutil.copy2(cap, output / cap.name)
+                    link_or_copy(img, output / img.name)
+                    link_or_copy(cap, output / cap.name)
                     count += 1
 
     print(f"Dataset prepared: {count} image-caption pairs in {output}")
@@ -4,7 +4,8 @@
 import argparse
 import torch
 from diffusers import FluxPipeline
-from peft import PeftModel
+from peft import LoraConfig, get_peft_model, set_peft_model_state_dict
+from safetensors.torch import load_file
 
 
 def main():
@@ -13,6 +14,7 @@ def main():
     parser.add_argument("--prompt", type=str, default="A mystical blue-skinned creature called Anky with purple swirling hair, golden eyes, and ancient wisdom, sitting in a field of cosmic flowers under a golden sunset")
     parser.add_argument("--output", type=str, default="test_output.png")
     parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--lora_rank", type=int, default=64)
     args = parser.parse_args()
 
     print(f"Loading FLUX.1-dev...")
@@ -23,8 +25,21 @@ def main():
     pipe = pipe.to("cuda:0")
 
     print(f"Loading LoRA from {args.lora_path}...")
-    lora_weights = torch.load(args.lora_path, map_location="cuda:0")
-    pipe.transformer.load_state_dict(lora_weights, strict=False)
+    # Same adapter layout as train_flux_lora.py, so the saved keys line up
+    lora_config = LoraConfig(
+        r=args.lora_rank,
+        lora_alpha=args.lora_rank,
+        target_modules=["to_q", "to_k", "to_v", "to_out.0"],
+        lora_dropout=0.0,
+        bias="none",
+    )
+    pipe.transformer = get_peft_model(pipe.transformer, lora_config)
+    lora_weights = load_file(args.lora_path, device="cuda:0")
+    result = set_peft_model_state_dict(pipe.transformer, lora_weights)
+    if result.unexpected_keys:
+        raise RuntimeError(
+            f"{len(result.unexpected_keys)} LoRA keys did not match the model, e.g. {result.unexpected_keys[0]}"
+        )
 
     print(f"Generating image...")
     image = pipe(
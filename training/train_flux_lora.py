@@ -6,6 +6,8 @@ Adapted from Z-Image-Turbo training script for FLUX.1-dev.
 - FLUX.1-dev (FluxPipeline from diffusers)
 - LoRA Rank 64, 4000 steps, 768x768, bf16
 - Dual GPU: transformer on GPU 0, VAE + text encoders on GPU 1
+- VAE latents + text embeddings cached to disk once before training, so the
+  training loop never crosses GPUs (GPU 1 is only used for the precompute)
 - JSON-line progress output for Rust server parsing
 """
 
@@ -13,13 +15,19 @@ import os
 import sys
 import json
 import argparse
+import functools
+import shutil
 import torch
+import torch.utils.checkpoint
+from itertools import islice
 from pathlib import Path
 from diffusers import FluxPipeline, AutoencoderKL
 from diffusers.optimization import get_scheduler
-from peft import LoraConfig, get_peft_model
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict
+from safetensors.torch import save_file
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
 from PIL import Image
 
 
@@ -34,6 +42,7 @@ def parse_args():
     parser.add_argument("--batch_size", type=int, default=1)
     parser.add_argument("--gradient_accumulation", type=int, default=4)
     parser.add_argument("--save_steps", type=int, default=500)
+    parser.add_argument("--log_every", type=int, default=10)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--gpu_id", type=int, default=0)
     parser.add_argument("--secondary_gpu_id", type=int, default=1)
@@ -49,15 +58,27 @@ class AnkyDataset(Dataset):
     def __init__(self, dataset_dir, resolution=768):
         self.dataset_dir = Path(dataset_dir)
         self.resolution = resolution
-        self.image_files = []
 
-        for ext in ["*.png", "*.jpg", "*.jpeg", "*.webp"]:
-            for img_path in self.dataset_dir.glob(ext):
-                caption_path = img_path.with_suffix(".txt")
-                if caption_path.exists():
-                    self.image_files.append((img_path, caption_path))
+        # Single directory pass; parallel lists of plain str paths are much
+        # lighter than Path tuples once copied into every dataloader worker.
+        with os.scandir(self.dataset_dir) as it:
+            names = sorted(e.name for e in it if e.is_file())
+        name_set = set(names)
 
-        log_json(event="dataset", pairs=len(self.image_files))
+        self.img_paths = []
+        cap_paths = []
+        for name in names:
+            if not name.endswith((".png", ".jpg", ".jpeg", ".webp")):
+                continue
+            caption_name = os.path.splitext(name)[0] + ".txt"
+            if caption_name in name_set:
+                self.img_paths.append(os.path.join(self.dataset_dir, name))
+                cap_paths.append(os.path.join(self.dataset_dir, caption_name))
+
+        # Captions are tiny and immutable, read them once here
+        self.captions = [Path(cp).read_text().strip() for cp in cap_paths]
+
+        log_json(event="dataset", pairs=len(self.img_paths))
 
         self.transforms = transforms.Compose([
             transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR),
@@ -65,27 +86,143 @@ class AnkyDataset(Dataset):
             transforms.ToTensor(),
             transforms.Normalize([0.5], [0.5]),
         ])
+        # Same pipeline for already-decoded uint8 CHW tensors (GPU JPEG path)
+        self.tensor_transforms = transforms.Compose([
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True),
+            transforms.CenterCrop(resolution),
+            transforms.Normalize([0.5], [0.5]),
+        ])
 
     def __len__(self):
-        return len(self.image_files)
-
-    def __getitem__(self, idx):
-        img_path, caption_path = self.image_files[idx]
+        return len(self.img_paths)
+
+    def cache_paths(self, idx):
+        """Latent + prompt embedding cache files, stored next to the image.
+
+        Keyed on the full file name so foo.png and foo.jpg don't collide.
+        """
+        img_path = self.img_paths[idx]
+        return f"{img_path}.latent.pt", f"{img_path}.embed.pt"
+
+    def load_pair(self, idx, device=None):
+        """Raw (pixel_values, caption) for the precompute pass.
+
+        On CUDA, JPEGs are decoded (nvJPEG) and resized on the GPU; other
+        formats, and JPEGs nvJPEG rejects, fall back to PIL on the CPU.
+        """
+        img_path = self.img_paths[idx]
+        if device is not None and device.type == "cuda" and img_path.endswith((".jpg", ".jpeg")):
+            try:
+                image = decode_jpeg(read_file(img_path), mode=ImageReadMode.RGB, device=device)
+                return self.tensor_transforms(image), self.captions[idx]
+            except RuntimeError:
+                pass  # nvJPEG can't handle e.g. CMYK/lossless JPEGs; PIL can
         image = Image.open(img_path).convert("RGB")
         image = self.transforms(image)
-        with open(caption_path, "r") as f:
-            caption = f.read().strip()
-        return {"pixel_values": image, "caption": caption}
+        return image, self.captions[idx]
+
+    def load_cache(self):
+        """Memory-map the tensors written by precompute_latents."""
+        self.latent_params = []
+        self.prompt_embeds = []
+        for idx in range(len(self)):
+            latent_path, embed_path = self.cache_paths(idx)
+            self.latent_params.append(torch.load(latent_path, map_location="cpu", mmap=True))
+            self.prompt_embeds.append(torch.load(embed_path, map_location="cpu", mmap=True))
+
+    def __getitem__(self, idx):
+        return {
+            "latent_params": self.latent_params[idx],
+            "prompt_embeds": self.prompt_embeds[idx],
+        }
+
+
+def cycle(loader):
+    """Yield batches forever; with persistent workers each pass reuses them."""
+    while True:
+        yield from loader
+
+
+@torch.compile
+def noise_mix(noise, latents, sigmas):
+    """(1 - sigma) * noise + sigma * latents, fused into one kernel.
+
+    bf16 in and out, with the math in fp32 (bf16 sigmas are too coarse near t=1).
+    """
+    return torch.lerp(noise.float(), latents.float(), sigmas).to(torch.bfloat16)
+
+
+def save_lora(transformer, path):
+    """Write only the LoRA adapter tensors as a real safetensors file."""
+    lora_sd = get_peft_model_state_dict(transformer)
+    # Queue every device->host copy, then wait once on the adapter's device(s)
+    cuda_devices = {v.device for v in lora_sd.values() if v.is_cuda}
+    lora_sd = {k: v.detach().contiguous().to("cpu", non_blocking=True) for k, v in lora_sd.items()}
+    for dev in cuda_devices:
+        torch.cuda.synchronize(dev)
+    save_file(lora_sd, str(path))
+
+
+@torch.no_grad()
+def precompute_latents(dataset, pipe):
+    """Run the frozen VAE + text encoders once per pair and cache the outputs.
+
+    Saves the full latent distribution (mean + logvar) rather than a sample,
+    so the training loop still draws a fresh latent every step.
+    """
+    # NHWC lets cuDNN pick tensor-core conv kernels for the VAE encoder
+    pipe.vae.to(memory_format=torch.channels_last)
+    vae_device = next(pipe.vae.parameters()).device
+    text_device = next(pipe.text_encoder.parameters()).device if hasattr(pipe, "text_encoder") else vae_device
+
+    # Datasets often repeat captions; run T5 + CLIP once per unique string and
+    # link repeats to the file already written (tensors don't stay in RAM)
+    embed_files = {}
+
+    for idx in range(len(dataset)):
+        pixel_values, caption = dataset.load_pair(idx, device=vae_device)
+        pixel_values = pixel_values.unsqueeze(0).to(
+            vae_device, dtype=torch.bfloat16, memory_format=torch.channels_last
+        )
+        latent_params = pipe.vae.encode(pixel_values).latent_dist.parameters
+
+        latent_path, embed_path = dataset.cache_paths(idx)
+        torch.save(latent_params[0].cpu(), latent_path)
+
+        # An earlier run may have left embed_path hardlinked to another image's
+        # file; replace it rather than write through the link
+        if os.path.exists(embed_path):
+            os.unlink(embed_path)
+
+        if caption not in embed_files:
+            prompt_embeds = pipe.encode_prompt(prompt=[caption], device=text_device)
+            if isinstance(prompt_embeds, (tuple, list)):
+                prompt_embeds = prompt_embeds[0]
+            torch.save(prompt_embeds[0].to(torch.bfloat16).cpu(), embed_path)
+            embed_files[caption] = embed_path
+        else:
+            try:
+                os.link(embed_files[caption], embed_path)
+            except OSError:
+                shutil.copyfile(embed_files[caption], embed_path)
+
+    log_json(event="precompute", pairs=len(dataset), unique_captions=len(embed_files))
 
 
 def main():
     args = parse_args()
     torch.manual_seed(args.seed)
 
+    # TF32 matmuls/convs and cuDNN autotuning for the fixed training shape
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     log_json(event="start", config=vars(args))
 
     if torch.cuda.is_available():
-        torch.cuda.empty_cache()
         for i in range(torch.cuda.device_count()):
             log_json(
                 event="gpu",
@@ -116,7 +253,14 @@ def main():
     )
 
     pipe.transformer = get_peft_model(pipe.transformer, lora_config)
-    pipe.transformer.enable_gradient_checkpointing()
+    # Explicit non-reentrant checkpointing (already the diffusers default for Flux blocks)
+    pipe.transformer.enable_gradient_checkpointing(
+        gradient_checkpointing_func=functools.partial(torch.utils.checkpoint.checkpoint, use_reentrant=False)
+    )
+
+    # Compiled view for the forward pass; pipe.transformer stays the plain
+    # PeftModel so parameters/state_dict keys are unaffected.
+    transformer = torch.compile(pipe.transformer, fullgraph=False)
 
     if hasattr(pipe, "vae") and hasattr(pipe.vae, "enable_slicing"):
         pipe.vae.enable_slicing()
@@ -140,14 +284,37 @@ def main():
 
     # Dataset
     dataset = AnkyDataset(args.dataset_dir, args.resolution)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+    precompute_latents(dataset, pipe)
+    dataset.load_cache()
+
+    # VAE + text encoders are no longer needed, free their memory
+    vae_scaling_factor = pipe.vae.config.scaling_factor
+    pipe.vae = None
+    pipe.text_encoder = None
+    pipe.text_encoder_2 = None
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
-    # Optimizer
+    # Items are two small cached tensors, so one worker keeps up; more just contend on the GIL
+    dataloader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=1,
+        pin_memory=device.type == "cuda",
+        persistent_workers=True,
+        prefetch_factor=4,
+        drop_last=True,
+    )
+
+    # Optimizer: only the LoRA params, single fused kernel per step on CUDA
+    trainable_params = [p for p in pipe.transformer.parameters() if p.requires_grad]
     optimizer = torch.optim.AdamW(
-        pipe.transformer.parameters(),
+        trainable_params,
         lr=args.learning_rate,
         betas=(0.9, 0.999),
         weight_decay=0.01,
+        **({"fused": True} if device.type == "cuda" else {"foreach": True}),
     )
 
     lr_scheduler = get_scheduler(
@@ -162,81 +329,89 @@ def main():
     global_step = 0
     pipe.transformer.train()
 
-    while global_step < args.max_train_steps:
-        for batch in dataloader:
-            pixel_values = batch["pixel_values"].to(device, dtype=torch.bfloat16)
-            captions = batch["caption"]
-
-            with torch.no_grad():
-                vae_device = next(pipe.vae.parameters()).device
-                latents = pipe.vae.encode(pixel_values.to(vae_device)).latent_dist.sample()
-                latents = latents * pipe.vae.config.scaling_factor
-                latents = latents.to(device)
-
-            noise = torch.randn_like(latents)
-            bsz = latents.shape[0]
-
-            timesteps = torch.rand(bsz, device=device)
-            sigmas = timesteps.view(-1, 1, 1, 1)
-            noisy_latents = (1 - sigmas) * noise + sigmas * latents
-            timesteps_scaled = (timesteps * 1000).long()
-
-            with torch.no_grad():
-                text_device = next(pipe.text_encoder.parameters()).device if hasattr(pipe, "text_encoder") else device
-                prompt_embeds = pipe.encode_prompt(prompt=captions, device=text_device)
-                if isinstance(prompt_embeds, (tuple, list)):
-                    prompt_embeds = prompt_embeds[0]
-                if hasattr(prompt_embeds, "to"):
-                    prompt_embeds = prompt_embeds.to(device=device, dtype=torch.bfloat16)
-
-            model_output = pipe.transformer(
-                noisy_latents.to(torch.bfloat16),
-                timesteps_scaled,
-                prompt_embeds,
-                return_dict=False,
-            )
-
-            if isinstance(model_output, (tuple, list)):
-                model_pred = model_output[0]
-                while isinstance(model_pred, (tuple, list)):
-                    model_pred = model_pred[0]
-            else:
-                model_pred = model_output
-
-            target = latents - noise
-            loss = torch.nn.functional.mse_loss(model_pred.float(), target.float(), reduction="mean")
-            loss.backward()
-
-            if (global_step + 1) % args.gradient_accumulation == 0:
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
-
-            global_step += 1
-
-            # JSON progress for Rust
+    # Running loss stays on the GPU; only synced when a progress line is emitted
+    loss_accum = torch.zeros((), device=device)
+    steps_since_log = 0
+
+    # Allocated on the first microbatch and reused; shapes are static (drop_last=True)
+    noise = None
+
+    # cycle() would spin forever on a loader that yields nothing (drop_last=True)
+    if len(dataloader) == 0:
+        raise ValueError(
+            f"Dataset has {len(dataset)} pairs, fewer than --batch_size {args.batch_size}; no full batch to train on"
+        )
+
+    # One optimizer step per `gradient_accumulation` microbatches
+    batches = islice(cycle(dataloader), args.max_train_steps * args.gradient_accumulation)
+    for micro_step, batch in enumerate(batches, start=1):
+        latent_params = batch["latent_params"].to(device, non_blocking=True)
+        prompt_embeds = batch["prompt_embeds"].to(device, dtype=torch.bfloat16, non_blocking=True)
+
+        # Sample from the cached latent distribution (same as latent_dist.sample())
+        mean, logvar = latent_params.chunk(2, dim=1)
+        logvar = logvar.clamp(-30.0, 20.0)
+        latents = mean + (0.5 * logvar).exp() * torch.randn_like(mean)
+        latents = latents * vae_scaling_factor
+
+        if noise is None:
+            noise = torch.empty_like(latents)
+        noise.normal_()
+        bsz = latents.shape[0]
+
+        timesteps = torch.rand(bsz, device=device)
+        sigmas = timesteps.view(-1, 1, 1, 1)
+        timesteps_scaled = (timesteps * 1000).long()
+
+        model_output = transformer(
+            noise_mix(noise, latents, sigmas),
+            timesteps_scaled,
+            prompt_embeds,
+            return_dict=False,
+        )
+        # return_dict=False always yields a 1-tuple (sample,)
+        model_pred = model_output[0]
+
+        target = latents - noise
+        # Pointwise ops stay in bf16; only the reduction accumulates in fp32
+        diff = model_pred - target
+        loss = diff.pow(2).sum(dtype=torch.float32) / diff.numel()
+        # Scale so the accumulated gradient is the mean over microbatches
+        (loss / args.gradient_accumulation).backward()
+        loss_accum += loss.detach()
+
+        if micro_step % args.gradient_accumulation != 0:
+            continue
+
+        optimizer.step()
+        lr_scheduler.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        global_step += 1
+        steps_since_log += 1
+
+        # JSON progress for Rust
+        if global_step % args.log_every == 0 or global_step == args.max_train_steps:
+            avg_loss = (loss_accum / (steps_since_log * args.gradient_accumulation)).item()
             log_json(
                 step=global_step,
                 total=args.max_train_steps,
-                loss=round(loss.item(), 6),
+                loss=round(avg_loss, 6),
                 lr=lr_scheduler.get_last_lr()[0],
             )
+            loss_accum.zero_()
+            steps_since_log = 0
 
-            if global_step % args.save_steps == 0:
-                ckpt_dir = Path(args.output_dir) / f"checkpoint-{global_step}"
-                ckpt_dir.mkdir(parents=True, exist_ok=True)
-                lora_dict = {k: v for k, v in pipe.transformer.state_dict().items()}
-                torch.save(lora_dict, ckpt_dir / "pytorch_lora_weights.safetensors")
-                log_json(event="checkpoint", step=global_step, path=str(ckpt_dir))
-
-            if global_step >= args.max_train_steps:
-                break
+        if global_step % args.save_steps == 0:
+            ckpt_dir = Path(args.output_dir) / f"checkpoint-{global_step}"
+            ckpt_dir.mkdir(parents=True, exist_ok=True)
+            save_lora(pipe.transformer, ckpt_dir / "pytorch_lora_weights.safetensors")
+            log_json(event="checkpoint", step=global_step, path=str(ckpt_dir))
 
     # Save final
     final_dir = Path(args.output_dir) / "final"
     final_dir.mkdir(parents=True, exist_ok=True)
-    lora_dict = {k: v for k, v in pipe.transformer.state_dict().items()}
-    torch.save(lora_dict, final_dir / "pytorch_lora_weights.safetensors")
+    save_lora(pipe.transformer, final_dir / "pytorch_lora_weights.safetensors")
     with open(final_dir / "config.json", "w") as f:
         json.dump(vars(args), f, indent=2)
 